@@ -0,0 +1,162 @@
+#!/usr/bin/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Record indexes shared between all the wsgi processes on a host
+"""
+
+import errno
+import json
+import os
+import sqlite3
+import stat
+import threading
+import time
+import zlib
+
+
+class IndexCache(object):
+    """A size bounded cache of log record indexes in a local sqlite file.
+
+    Under mod_wsgi we run as many daemon processes, so anything we cached
+    in memory would be built once per process and lost every time one is
+    recycled. Keeping it in a sqlite file lets every process share it. The
+    database is in WAL mode, so readers never wait on each other or on a
+    writer.
+
+    Entries are keyed by path, and only match while the file has the same
+    mtime and size, so a log that is still being written never gets a stale
+    index. Once the entries add up to more than max_bytes the oldest ones
+    are evicted.
+
+    The cache is only ever an optimization, so any error talking to the
+    database is treated as a cache miss. With no path there's no cache.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = local_connection(self._local, self.path)
+        if not getattr(self._local, 'ready', False):
+            conn.execute('CREATE TABLE IF NOT EXISTS indexes ('
+                         'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+                         'bytes INTEGER, created REAL, data BLOB)')
+            self._local.ready = True
+        return conn
+
+    def _lookup(self, columns, fname):
+        if self.path is None:
+            return None
+        st = os.stat(fname)
+        return self._conn().execute(
+            'SELECT %s FROM indexes WHERE path = ? AND mtime = ? AND size = ?'
+            % columns, (fname, st.st_mtime, st.st_size)).fetchone()
+
+    def get(self, fname):
+        """Return the record index for fname, or None if it isn't cached."""
+        try:
+            row = self._lookup('data', fname)
+        except (OSError, sqlite3.Error):
+            return None
+        if row is None:
+            return None
+        try:
+            return [(first, num, str(sev), str(linesev))
+                    for first, num, sev, linesev
+                    in json.loads(zlib.decompress(row[0]))]
+        except (ValueError, zlib.error):
+            # not an index we know how to read
+            return None
+
+    def get_bytes(self, fname):
+        """Return the uncompressed size of fname, or None if not cached."""
+        try:
+            row = self._lookup('bytes', fname)
+        except (OSError, sqlite3.Error):
+            return None
+        if row is None:
+            return None
+        return row[0]
+
+    def put(self, fname, st, nbytes, index):
+        """Store the index for fname, nbytes is its uncompressed size.
+
+        st is the stat of fname from before we started reading it, so that
+        if it was appended to while we read it, the index can't match the
+        longer file.
+        """
+        if self.path is None:
+            return
+        data = zlib.compress(json.dumps(index, separators=(',', ':')))
+        if len(data) > self.max_bytes:
+            return
+
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO indexes VALUES (?, ?, ?, ?, ?, ?)',
+                    (fname, st.st_mtime, st.st_size, nbytes, time.time(),
+                     sqlite3.Binary(data)))
+                self._evict(conn)
+        except (OSError, sqlite3.Error):
+            pass
+
+    def _evict(self, conn):
+        rows = conn.execute('SELECT path, LENGTH(data) FROM indexes '
+                            'ORDER BY created DESC').fetchall()
+        total = 0
+        for path, size in rows:
+            total += size
+            if total > self.max_bytes:
+                conn.execute('DELETE FROM indexes WHERE path = ?', (path,))
+
+
+def local_connection(local, path):
+    """Get the sqlite connection to path for this thread and process.
+
+    sqlite connections can't be shared between threads, or with a process
+    we forked, so we keep one per thread in local, and start over if we
+    find ourselves in a new process.
+    """
+    if getattr(local, 'pid', None) != os.getpid():
+        local.__dict__.clear()
+        conn = sqlite3.connect(path, timeout=5)
+        conn.execute('PRAGMA journal_mode=WAL')
+        local.conn = conn
+        local.pid = os.getpid()
+    return local.conn
+
+
+def private_dir(path):
+    """Make sure path is a directory that only we can get at.
+
+    Anyone who could write to it could plant entries that hide or regroup
+    lines in the logs we show, so if it isn't ours alone we don't use it.
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            return False
+
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and
+            not st.st_mode & 0o077)
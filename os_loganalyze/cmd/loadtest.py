@@ -0,0 +1,339 @@
+#!/usr/bin/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Replay a trace of requests against the log filter and report how it copes
+
+The trace is a file with one JSON request per line, like:
+
+    {"path": "12/34/check/foo/screen-n-api.txt.gz", "level": "INFO",
+     "html": true, "size": 12317962}
+
+Only path is required. level, html (default true), or a raw query string in
+query, say what was asked for, and size is the uncompressed size of the
+log, which we use to generate a synthetic log of the same size. Logs
+without a size get one picked from SIZES, which are the sizes of some real
+gate logs.
+
+By default requests are made to os_loganalyze.wsgi.application in this
+process, with the synthetic logs as its root, and a state dir of its own
+that starts out empty for every concurrency level, so we never share the
+index cache or admission slots with a real instance on the same host, or
+with an earlier level. Given --url they are made over http instead, to an
+instance serving the tree given with --root.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import Queue
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+from wsgiref.util import setup_testing_defaults
+
+import os_loganalyze.wsgi
+
+
+SIZES = [1178755, 1854572, 2506283, 10951213, 12317962, 17390791]
+
+LEVELS = ['DEBUG'] * 90 + ['INFO'] * 7 + ['WARNING'] * 2 + ['ERROR']
+
+DEFAULT_TRACE = [
+    {'path': 'screen-n-api.txt.gz'},
+    {'path': 'screen-n-api.txt.gz', 'level': 'INFO'},
+    {'path': 'screen-q-svc.txt.gz', 'level': 'ERROR'},
+    {'path': 'screen-q-svc.txt.gz', 'html': False},
+    {'path': 'screen-key.txt.gz'},
+    {'path': 'screen-c-api.txt.gz'},
+    {'path': 'screen-c-api.txt.gz', 'level': 'WARNING', 'html': False},
+    {'path': 'devstacklog.txt.gz'},
+    ]
+
+
+def load_trace(fname):
+    trace = []
+    with open(fname) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                trace.append(json.loads(line))
+    return trace
+
+
+def query_of(request):
+    if 'query' in request:
+        return request['query']
+    if request.get('level'):
+        return urllib.urlencode({'level': request['level']})
+    return ''
+
+
+def synthetic_lines(rand):
+    """Generator of oslo style log lines, with the odd traceback."""
+    when = time.mktime((2013, 9, 27, 18, 0, 0, 0, 0, -1))
+    pid = rand.randint(1000, 9999)
+    while True:
+        when += rand.random() / 100
+        date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))
+        date = '%s.%03d %d' % (date, (when % 1) * 1000, pid)
+        level = rand.choice(LEVELS)
+        yield ('%s %s nova.compute.manager [req-%08x] synthetic message %d\n'
+               % (date, level, rand.getrandbits(32), rand.getrandbits(16)))
+        if level == 'ERROR':
+            yield '%s TRACE nova.compute.manager Traceback\n' % date
+            for i in range(rand.randint(2, 20)):
+                yield ('%s TRACE nova.compute.manager   File "foo.py", '
+                       'line %d\n' % (date, i))
+
+
+def make_log(fname, size, rand):
+    """Write a synthetic log with roughly size bytes of uncompressed data."""
+    if not os.path.isdir(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+    if fname.endswith('.gz'):
+        f = gzip.open(fname, 'wb')
+    else:
+        f = open(fname, 'wb')
+
+    written = 0
+    for line in synthetic_lines(rand):
+        if written >= size:
+            break
+        f.write(line)
+        written += len(line)
+    f.close()
+
+
+def make_tree(root, trace, rand):
+    """Make a synthetic log for every log the trace asks for."""
+    sizes = {}
+    for request in trace:
+        if request.get('size'):
+            sizes[request['path']] = request['size']
+        else:
+            sizes.setdefault(request['path'], rand.choice(SIZES))
+
+    for path, size in sizes.items():
+        make_log(os.path.join(root, path), size, rand)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def inprocess_request(root, state_dir, request):
+    """Make a request to the wsgi app in this process.
+
+    Returns (status, time to first byte, total time, bytes).
+    """
+    environ = {'PATH_INFO': '/htmlify/%s' % request['path'],
+               'QUERY_STRING': query_of(request),
+               os_loganalyze.wsgi.STATE_DIR_ENV: state_dir}
+    if request.get('html', True):
+        environ['HTTP_ACCEPT'] = 'text/html'
+    setup_testing_defaults(environ)
+
+    response = {}
+
+    def start_response(status, headers):
+        response['status'] = status
+
+    start = time.time()
+    ttfb = None
+    nbytes = 0
+    result = os_loganalyze.wsgi.application(environ, start_response,
+                                            root_path=root)
+    try:
+        for chunk in result:
+            if ttfb is None:
+                ttfb = time.time() - start
+            nbytes += len(chunk)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    end = time.time() - start
+    return response['status'], ttfb or end, end, nbytes
+
+
+def http_request(url, request):
+    """Make a request to a served instance, returns like inprocess_request."""
+    query = query_of(request)
+    full = '%s/htmlify/%s%s' % (url.rstrip('/'), request['path'],
+                                '?' + query if query else '')
+    req = urllib2.Request(full)
+    if request.get('html', True):
+        req.add_header('Accept', 'text/html')
+
+    start = time.time()
+    nbytes = 0
+    try:
+        resp = urllib2.urlopen(req)
+        status = '%d OK' % resp.getcode()
+    except urllib2.HTTPError as e:
+        resp = e
+        status = '%d %s' % (e.code, e.msg)
+    try:
+        # a big first read would wait for more than the first byte
+        chunk = resp.read(1)
+        ttfb = time.time() - start
+        while chunk:
+            nbytes += len(chunk)
+            chunk = resp.read(64 * 1024)
+    finally:
+        resp.close()
+    end = time.time() - start
+    return status, ttfb, end, nbytes
+
+
+def run(trace, concurrency, do_request):
+    """Replay the trace with concurrency workers, returns (results, secs)."""
+    requests = Queue.Queue()
+    for request in trace:
+        requests.put(request)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                request = requests.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = do_request(request)
+            except Exception as e:
+                result = ('error %s' % e, 0.0, 0.0, 0)
+            with lock:
+                results.append(result)
+
+    start = time.time()
+    workers = [threading.Thread(target=worker) for i in range(concurrency)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return results, time.time() - start
+
+
+def summarize(concurrency, results, elapsed):
+    """Work out the numbers to report for a run.
+
+    Busy responses and errors come back much faster than real renders, so
+    they're counted separately and left out of the throughput, latencies
+    and bytes.
+    """
+    ok = [r for r in results if r[0].startswith('200')]
+    errors = len(results) - len(ok)
+    latencies = [r[2] for r in ok]
+    ttfbs = [r[1] for r in ok]
+    return {
+        'concurrency': concurrency,
+        'requests': len(results),
+        'errors': errors,
+        'ok_rate': len(ok) / elapsed if elapsed else 0.0,
+        'error_rate': errors / elapsed if elapsed else 0.0,
+        'mbytes': sum(r[3] for r in ok) / 1024.0 / 1024.0,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'ttfb_p50': percentile(ttfbs, 50),
+        'ttfb_p99': percentile(ttfbs, 99),
+        }
+
+
+def maxrss_mb():
+    """Peak memory of this process so far, in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+REPORT_HEADER = ('conc  reqs  errs    ok/s   err/s     MB  p50(s)  p99(s)  '
+                 'ttfb50  ttfb99')
+REPORT_FORMAT = ('%(concurrency)4d %(requests)5d %(errors)5d '
+                 '%(ok_rate)7.2f %(error_rate)7.2f %(mbytes)6.1f '
+                 '%(p50)7.3f %(p99)7.3f %(ttfb_p50)7.3f %(ttfb_p99)7.3f')
+# the memory we can see is our own, so it's only reported when the requests
+# are served in this process
+MAXRSS_HEADER = '  maxrss(MB)'
+MAXRSS_FORMAT = ' %(maxrss_mb)11.1f'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay a request trace against os_loganalyze.')
+    parser.add_argument('trace', nargs='?',
+                        help='JSON lines request trace, defaults to a mix '
+                        'of html, text and level requests')
+    parser.add_argument('--concurrency', default='1,4,16',
+                        help='comma separated concurrency levels to run')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='how many times to replay the trace per level')
+    parser.add_argument('--root',
+                        help='use this log tree instead of generating one')
+    parser.add_argument('--url',
+                        help='make requests to this url over http, which '
+                        'should be serving the log tree given with --root')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    if args.url and not args.root:
+        # a tree we generate isn't one the server can see
+        parser.error('--url requires --root')
+
+    trace = load_trace(args.trace) if args.trace else DEFAULT_TRACE
+    trace = trace * args.repeat
+
+    root = args.root
+    if not root:
+        root = tempfile.mkdtemp()
+        print 'Generating synthetic logs in %s' % root
+        make_tree(root, trace, random.Random(args.seed))
+    root = os.path.join(os.path.abspath(root), '')
+
+    header = REPORT_HEADER
+    report = REPORT_FORMAT
+    if not args.url:
+        header += MAXRSS_HEADER
+        report += MAXRSS_FORMAT
+
+    try:
+        print header
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            if args.url:
+                results, elapsed = run(
+                    trace, concurrency,
+                    lambda request: http_request(args.url, request))
+            else:
+                state_dir = tempfile.mkdtemp()
+                try:
+                    results, elapsed = run(
+                        trace, concurrency,
+                        lambda request: inprocess_request(root, state_dir,
+                                                          request))
+                finally:
+                    shutil.rmtree(state_dir)
+            summary = summarize(concurrency, results, elapsed)
+            # this is the peak for the whole run so far
+            summary['maxrss_mb'] = maxrss_mb()
+            print report % summary
+    finally:
+        if not args.root:
+            shutil.rmtree(root)
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Follow logs that are still being written
+"""
+
+import os
+import threading
+import time
+
+
+READ_SIZE = 64 * 1024
+# how much recently appended data a watcher keeps for slow followers
+BUFFER_BYTES = 1024 * 1024
+
+
+class FileWatcher(object):
+    """Watch a file for appended lines on behalf of all its followers.
+
+    Every client following the same file shares one watcher, which polls
+    the file size and reads whatever complete lines were appended since
+    last time. That's one incremental read per poll no matter how many
+    people are following, rather than everyone reloading the whole file.
+
+    Appended data is kept as (offset, data) chunks, up to BUFFER_BYTES of
+    them, and followers ask for everything after the offset they're at.
+    """
+
+    def __init__(self, fname, interval):
+        self.fname = fname
+        self.interval = interval
+        self.offset = line_end(fname)
+        self.followers = 0
+        self.chunks = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def _read(self):
+        try:
+            size = os.path.getsize(self.fname)
+        except OSError:
+            return None
+        if size < self.offset:
+            # truncated or replaced, just carry on from the new end
+            self.offset = size
+        if size == self.offset:
+            return None
+
+        with open(self.fname, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        # hold back a partial last line until the rest is written
+        end = data.rfind('\n') + 1
+        if end == 0:
+            return None
+        return data[:end]
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            data = self._read()
+            with self._cond:
+                if self.followers == 0:
+                    return
+                if data is None:
+                    continue
+
+                self.chunks.append((self.offset, data))
+                self.offset += len(data)
+                while (len(self.chunks) > 1 and
+                       self.offset - self.chunks[1][0] > BUFFER_BYTES):
+                    self.chunks.pop(0)
+                self._cond.notify_all()
+
+    def add_follower(self):
+        with self._cond:
+            self.followers += 1
+
+    def remove_follower(self):
+        with self._cond:
+            self.followers -= 1
+            return self.followers
+
+    def follow(self, offset, idle_timeout):
+        """Generator of lists of lines appended after offset.
+
+        This stops once nothing has been appended for idle_timeout seconds.
+        If a follower falls further behind than we buffer, it skips ahead.
+        """
+        while True:
+            deadline = time.time() + idle_timeout
+            with self._cond:
+                while self.offset <= offset:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return
+                    self._cond.wait(remaining)
+                data = [chunk for start, chunk in self.chunks
+                        if start >= offset]
+                offset = self.offset
+            yield split_lines("".join(data))
+
+
+def split_lines(data):
+    """Split data into lines the same way reading a file does."""
+    lines = data.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+WATCHERS = {}
+WATCHERS_LOCK = threading.Lock()
+
+
+def watch(fname, interval, max_followers):
+    """Start following fname, sharing a watcher if there already is one.
+
+    Returns None if there are already max_followers following files in
+    this process, each of which is tying up a worker.
+    """
+    with WATCHERS_LOCK:
+        following = sum(w.followers for w in WATCHERS.values())
+        if following >= max_followers:
+            return None
+
+        watcher = WATCHERS.get(fname)
+        if watcher is None:
+            watcher = FileWatcher(fname, interval)
+            watcher.start()
+            WATCHERS[fname] = watcher
+        watcher.add_follower()
+        return watcher
+
+
+def unwatch(watcher):
+    """Stop following, the watcher stops once nobody is following."""
+    with WATCHERS_LOCK:
+        if watcher.remove_follower() == 0:
+            del WATCHERS[watcher.fname]
+
+
+def line_end(fname):
+    """Find the offset just after the last complete line in fname."""
+    pos = os.path.getsize(fname)
+    with open(fname, 'rb') as f:
+        while pos > 0:
+            size = min(READ_SIZE, pos)
+            pos -= size
+            f.seek(pos)
+            i = f.read(size).rfind('\n')
+            if i >= 0:
+                return pos + i + 1
+    return 0
+
+
+def tail_offset(fname, end, nlines):
+    """Find the offset of the start of the last nlines lines before end."""
+    pos = end
+    found = 0
+    with open(fname, 'rb') as f:
+        while pos > 0:
+            size = min(READ_SIZE, pos)
+            pos -= size
+            f.seek(pos)
+            data = f.read(size)
+            if pos + size == end and data.endswith('\n'):
+                data = data[:-1]
+            i = len(data)
+            while True:
+                i = data.rfind('\n', 0, i)
+                if i < 0:
+                    break
+                found += 1
+                if found == nlines:
+                    return pos + i + 1
+    return 0
+
+
+def read_lines(fname, start, end):
+    """Generator of lists of lines in fname between the start and end."""
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        left = end - start
+        partial = ''
+        while left > 0:
+            data = f.read(min(READ_SIZE, left))
+            if not data:
+                break
+            left -= len(data)
+            lines = split_lines(partial + data)
+            partial = ''
+            if not lines[-1].endswith('\n'):
+                partial = lines.pop()
+            if lines:
+                yield lines
+        if partial:
+            yield [partial]
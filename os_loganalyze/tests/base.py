@@ -17,11 +17,13 @@
 
 import os
 import os.path
+import tempfile
 from wsgiref.util import setup_testing_defaults
 
 import fixtures
 import testtools
 
+from os_loganalyze import cache
 import os_loganalyze.wsgi as log_wsgi
 
 
@@ -67,11 +69,35 @@ class TestCase(testtools.TestCase):
 
         self.log_fixture = self.useFixture(fixtures.FakeLogger())
 
+        # NestedTempfile gives every test its own private tempdir, which we
+        # use for the shared state
+        self.state_dir = tempfile.gettempdir()
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi._state_dir', self.state_dir))
+        # and if anything forgets to pass it in, it still stays in here
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.STATE_DIR',
+            os.path.join(self.state_dir, 'default-state')))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.ADMISSION',
+            self.make_admission(log_wsgi.MAX_RENDERS,
+                                log_wsgi.MAX_QUEUED_RENDERS)))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.INDEX_CACHE',
+            cache.IndexCache(os.path.join(self.state_dir, 'index.sqlite'),
+                             log_wsgi.CACHE_MAX_BYTES)))
+
+    def make_admission(self, max_renders, max_queued):
+        return log_wsgi.RenderAdmission(
+            os.path.join(self.state_dir, 'admission.sqlite'),
+            max_renders, log_wsgi.MAX_RENDER_BYTES, max_queued)
+
     def _start_response(self, *args):
         return
 
     def fake_env(self, **kwargs):
-        environ = dict(**kwargs)
+        environ = {log_wsgi.STATE_DIR_ENV: self.state_dir}
+        environ.update(kwargs)
         setup_testing_defaults(environ)
         return environ
 
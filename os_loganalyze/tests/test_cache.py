@@ -0,0 +1,207 @@
+#!/usr/bin/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Test the shared record index cache
+"""
+
+import json
+import os
+import tempfile
+import zlib
+
+import fixtures
+
+from os_loganalyze import cache
+from os_loganalyze.tests import base
+import os_loganalyze.wsgi as log_wsgi
+
+
+class TestIndexCache(base.TestCase):
+
+    def setUp(self):
+        super(TestIndexCache, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.cache = cache.IndexCache(os.path.join(self.dir, 'index.db'),
+                                      1024 * 1024)
+
+    def make_log(self, name, content='foo\n'):
+        fname = os.path.join(self.dir, name)
+        with open(fname, 'w') as f:
+            f.write(content)
+        return fname
+
+    def test_put_get(self):
+        fname = self.make_log('screen-n-api.txt')
+        index = [(0, 2, 'NONE', 'NONE'), (2, 1, 'ERROR', 'ERROR')]
+        self.assertIsNone(self.cache.get(fname))
+        self.assertIsNone(self.cache.get_bytes(fname))
+
+        self.cache.put(fname, os.stat(fname), 100, index)
+        self.assertEqual(self.cache.get(fname), index)
+        self.assertEqual(self.cache.get_bytes(fname), 100)
+
+        # another process sees the same entries
+        other = cache.IndexCache(self.cache.path, self.cache.max_bytes)
+        self.assertEqual(other.get(fname), index)
+
+    def test_changed_file(self):
+        fname = self.make_log('screen-n-api.txt')
+        self.cache.put(fname, os.stat(fname), 100, [(0, 1, 'INFO', 'INFO')])
+
+        with open(fname, 'a') as f:
+            f.write('bar\n')
+        self.assertIsNone(self.cache.get(fname))
+
+    def test_missing_file(self):
+        self.assertIsNone(self.cache.get(os.path.join(self.dir, 'nope')))
+
+    def test_no_path(self):
+        fname = self.make_log('screen-n-api.txt')
+        disabled = cache.IndexCache(None, 1024)
+        disabled.put(fname, os.stat(fname), 100, [(0, 1, 'INFO', 'INFO')])
+        self.assertIsNone(disabled.get(fname))
+        self.assertIsNone(disabled.get_bytes(fname))
+
+    def test_private_dir(self):
+        path = os.path.join(self.dir, 'state')
+        self.assertTrue(cache.private_dir(path))
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+        self.assertTrue(cache.private_dir(path))
+
+        os.chmod(path, 0o777)
+        self.assertFalse(cache.private_dir(path))
+
+        self.assertFalse(cache.private_dir(self.make_log('file')))
+        os.symlink(self.dir, os.path.join(self.dir, 'link'))
+        self.assertFalse(cache.private_dir(os.path.join(self.dir, 'link')))
+
+    def test_bad_database(self):
+        fname = self.make_log('screen-n-api.txt')
+        broken = cache.IndexCache(self.dir, 1024)
+        broken.put(fname, os.stat(fname), 100, [(0, 1, 'INFO', 'INFO')])
+        self.assertIsNone(broken.get(fname))
+
+    def test_evict(self):
+        index = [(i, 1, 'DEBUG', 'DEBUG') for i in range(1000)]
+        size = len(zlib.compress(json.dumps(index, separators=(',', ':'))))
+        self.cache.max_bytes = size * 2
+        fnames = [self.make_log('log%d' % i) for i in range(3)]
+        for fname in fnames:
+            self.cache.put(fname, os.stat(fname), 100, index)
+
+        self.assertIsNone(self.cache.get(fnames[0]))
+        self.assertEqual(self.cache.get(fnames[1]), index)
+        self.assertEqual(self.cache.get(fnames[2]), index)
+
+
+class TestCachedFilters(base.TestCase):
+
+    def make_log(self, lines):
+        root = tempfile.mkdtemp() + '/'
+        fname = root + 'screen-n-cpu.txt'
+        with open(fname, 'w') as f:
+            f.write("".join(lines))
+        return root, fname
+
+    def text(self, root, level=None):
+        query = 'level=%s' % level if level else ''
+        return "".join(log_wsgi.application(
+            self.fake_env(PATH_INFO='/htmlify/screen-n-cpu.txt',
+                          QUERY_STRING=query),
+            self._start_response, root_path=root))
+
+    def test_appended_while_reading(self):
+        lines = ["2013-09-27 18:23:42.%03d 2820 ERROR nova [-] oops\n" % i
+                 for i in range(8)]
+        root, fname = self.make_log(lines[:5])
+
+        gen = log_wsgi.passthrough_filter(fname, 'ERROR')
+        gen.next()
+        with open(fname, 'a') as f:
+            f.write("".join(lines[5:]))
+        os.utime(fname, (1, 1))
+        self.assertEqual(len(list(gen)), 7)
+
+        # we didn't store an index for the file as it was before or after
+        self.assertIsNone(log_wsgi.INDEX_CACHE.get(fname))
+        self.assertEqual(self.text(root), "".join(lines))
+        self.assertEqual(self.text(root, 'ERROR'), "".join(lines))
+
+    def test_index_too_short(self):
+        lines = ["2013-09-27 18:23:42.%03d 2820 ERROR nova [-] oops\n" % i
+                 for i in range(4)]
+        records = list(log_wsgi.indexed_records(
+            lines, [(0, 1, 'ERROR', 'ERROR'), (1, 1, 'ERROR', 'ERROR')]))
+        self.assertEqual([record for _, record, _ in records],
+                         [[line] for line in lines])
+        self.assertEqual([sev for sev, _, _ in records], ['ERROR'] * 4)
+
+    def test_cached_split_record(self):
+        # the part of a split record that comes from the index is colored
+        # like the first time around
+        lines = ["2013-09-27 18:23:42.912 2820 INFO nova [-] dump\n"]
+        lines += ["line %d\n" % i for i in range(600)]
+        root, fname = self.make_log(lines)
+
+        def html(root):
+            return "".join(log_wsgi.application(
+                self.fake_env(PATH_INFO='/htmlify/screen-n-cpu.txt',
+                              HTTP_ACCEPT='text/html'),
+                self._start_response, root_path=root))
+        first = html(root)
+        self.assertIsNotNone(log_wsgi.INDEX_CACHE.get(fname))
+        self.assertEqual(first.count("class='INFO"), 601)
+        self.assertEqual(html(root), first)
+
+    def test_configure(self):
+        state_dir = os.path.join(tempfile.mkdtemp(), 'state')
+        log_wsgi.configure({log_wsgi.STATE_DIR_ENV: state_dir})
+        self.assertEqual(log_wsgi.INDEX_CACHE.path,
+                         os.path.join(state_dir, 'index.sqlite'))
+        self.assertEqual(os.stat(state_dir).st_mode & 0o777, 0o700)
+
+        # someone else can write here, so we don't use it
+        state_dir = tempfile.mkdtemp()
+        os.chmod(state_dir, 0o777)
+        log_wsgi.configure({log_wsgi.STATE_DIR_ENV: state_dir})
+        self.assertIsNone(log_wsgi.INDEX_CACHE.path)
+
+    def test_cached_render(self):
+        fname = 'screen-q-svc.txt.gz'
+        path = base.samples_path() + fname
+        self.assertIsNone(log_wsgi.INDEX_CACHE.get(path))
+
+        first = list(self.get_generator(fname, level='TRACE'))
+        index = log_wsgi.INDEX_CACHE.get(path)
+        self.assertEqual(sum(r[1] for r in index), 47887)
+        self.assertEqual(index[0], (0, 4, 'NONE', 'NONE'))
+        self.assertEqual(index[1], (4, 1, 'INFO', 'INFO'))
+        errors = [r for r in index if r[2] == 'ERROR']
+        self.assertEqual(len(errors), 72)
+        self.assertEqual(sum(r[1] for r in errors), 661)
+        self.assertEqual(log_wsgi.INDEX_CACHE.get_bytes(path), 10951213)
+
+        # the second time around we don't classify records at all, the
+        # index covers every line
+        def no_lines(lines, *args):
+            self.assertEqual(list(lines), [])
+            return iter([])
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.log_records', no_lines))
+        second = list(self.get_generator(fname, level='TRACE'))
+        self.assertEqual(first, second)
+
+        text = list(self.get_generator(fname, level='ERROR', html=False))
+        self.assertEqual(len(text), 661)
@@ -18,8 +18,12 @@
 Test the ability to convert files into wsgi generators
 """
 
+import os
+import re
+import tempfile
 
 from os_loganalyze.tests import base
+import os_loganalyze.wsgi as log_wsgi
 
 
 class TestFilters(base.TestCase):
@@ -92,3 +96,240 @@ class TestFilters(base.TestCase):
         line = gen.next()
         self.assertIn("<a name='_2013-09-27_18_07_11_884' "
                       "class='date' href='#_2013-09-27_18_07_11_884'>", line)
+
+    def test_error_keeps_traceback(self):
+        gen = self.get_generator('screen-q-svc.txt.gz', level='ERROR')
+        gen.next()
+
+        gen.next()
+        # the second ERROR is a whole traceback in a single record
+        record = gen.next()
+        self.assertIn("class='ERROR", record)
+        self.assertIn("delete failed", record)
+        self.assertIn("class='TRACE", record)
+        self.assertIn("Traceback (most recent call last):", record)
+
+
+class TestRecords(base.TestCase):
+
+    def test_log_records(self):
+        lines = [
+            "+ exec foo\n",
+            "2013-09-27 18:23:42.912 2820 DEBUG amqp [-] Channel open\n",
+            "\n",
+            "2013-09-27 18:23:42.923 2820 ERROR neutron [-] delete failed\n",
+            "2013-09-27 18:23:42.923 2820 TRACE neutron Traceback\n",
+            "2013-09-27 18:23:42.923 2820 TRACE neutron   File \"foo\"\n",
+            "2013-09-27 18:23:42.924 2820 INFO neutron [-] done\n",
+            ]
+        records = list(log_wsgi.log_records(lines))
+        self.assertEqual(
+            [(sev, len(record)) for sev, record, _ in records],
+            [('NONE', 1), ('DEBUG', 2), ('ERROR', 3), ('INFO', 1)])
+        self.assertEqual(records[2][2], ['ERROR', 'TRACE', 'TRACE'])
+
+    def test_log_records_no_sev(self):
+        lines = ["2013-09-27 18:23:42.923 2820 ERROR neutron [-] oops\n",
+                 "2013-09-27 18:23:42.923 2820 TRACE neutron Traceback\n"]
+        records = list(log_wsgi.log_records(lines, supports_sev=False))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[1][0], 'NONE')
+
+    def test_log_records_split(self):
+        lines = ["2013-09-27 18:23:42.923 2820 ERROR neutron [-] oops\n"]
+        lines += ["continued\n"] * (log_wsgi.MAX_RECORD_LINES * 2)
+        records = list(log_wsgi.log_records(lines))
+        self.assertEqual([(sev, len(record)) for sev, record, _ in records],
+                         [('ERROR', log_wsgi.MAX_RECORD_LINES)] * 2 +
+                         [('ERROR', 1)])
+        self.assertEqual(records[1][2],
+                         ['ERROR'] * log_wsgi.MAX_RECORD_LINES)
+
+        lines = ["x" * 1000 + "\n"] * 200
+        records = list(log_wsgi.log_records(lines))
+        self.assertTrue(len(records) > 1)
+        for sev, record, _ in records:
+            self.assertEqual(sev, 'NONE')
+            self.assertTrue(sum(len(line) for line in record) <=
+                            log_wsgi.MAX_RECORD_BYTES + 1001)
+
+    def test_no_headers_streams(self):
+        root = tempfile.mkdtemp() + '/'
+        with open(root + 'screen-n-api.txt', 'w') as f:
+            f.write("no header on this line\n" * 20000)
+        gen = log_wsgi.html_filter(root + 'screen-n-api.txt', 'NONE')
+        gen.next()
+        for chunk in gen:
+            self.assertTrue(len(chunk) < 2 * log_wsgi.MAX_RECORD_BYTES)
+
+
+class TestCompare(base.TestCase):
+
+    passing = [
+        "2013-09-27 18:23:42.912 2820 DEBUG amqp [-] Channel open\n",
+        "2013-09-27 18:23:42.913 2820 INFO nova [req-2560dc49-a31f-4ff2-"
+        "a89c-2d9d0948de59 demo] Started instance "
+        "3c42d0a7-4c51-4b4a-9d39-81b5bd0e4c1c\n",
+        ]
+    failing = [
+        "2013-09-28 10:01:02.001 1234 DEBUG amqp [-] Channel open\n",
+        "2013-09-28 10:01:02.002 1234 ERROR nova [-] <delete> failed\n",
+        "2013-09-28 10:01:02.002 1234 TRACE nova Traceback\n",
+        "2013-09-28 10:01:02.003 1234 INFO nova [req-74afcb7a-080c-4dd7-"
+        "a009-80fc12df4171 demo] Started instance "
+        "91b0cd5f-1111-4b4a-9d39-81b5bd0e4c1c\n",
+        ]
+
+    def setUp(self):
+        super(TestCompare, self).setUp()
+        self.root = tempfile.mkdtemp() + '/'
+        for name, lines in (('pass', self.passing), ('fail', self.failing)):
+            os.mkdir(os.path.join(self.root, name))
+            fname = os.path.join(self.root, name, 'screen-n-cpu.txt')
+            with open(fname, 'w') as f:
+                f.write("".join(lines))
+
+    def compare(self, query, html=False):
+        kwargs = {'PATH_INFO': '/htmlify/fail/screen-n-cpu.txt',
+                  'QUERY_STRING': query}
+        if html:
+            kwargs['HTTP_ACCEPT'] = 'text/html'
+        return log_wsgi.application(
+            self.fake_env(**kwargs), self._start_response,
+            root_path=self.root)
+
+    def test_normalize_line(self):
+        self.assertEqual(log_wsgi.normalize_line(self.passing[1]),
+                         log_wsgi.normalize_line(self.failing[3]))
+        self.assertEqual(
+            log_wsgi.normalize_line(
+                "(keystone-all): 2013-09-27 18:20:55,636 DEBUG cfg foo\n"),
+            "(keystone-all):  DEBUG cfg foo\n")
+
+    def test_compare(self):
+        gen = self.compare('compare=pass/screen-n-cpu.txt')
+        self.assertEqual(list(gen), ["".join(self.failing[1:3])])
+
+    def test_compare_html(self):
+        gen = self.compare('compare=pass/screen-n-cpu.txt', html=True)
+        self.assertIn("Display level: ", gen.next())
+        record = gen.next()
+        self.assertIn("class='ERROR", record)
+        self.assertIn("&lt;delete&gt;", record)
+        self.assertIn("class='TRACE", record)
+        self.assertIn("href='#_2013-09-28_10_01_02_002'", record)
+        self.assertIn("</html>", gen.next())
+
+    def test_compare_selector(self):
+        # switching level stays on the comparison
+        gen = self.compare('compare=pass/screen-n-cpu.txt&render=runs',
+                           html=True)
+        selector = gen.next()
+        self.assertIn("href='?render=runs&amp;"
+                      "compare=pass%2Fscreen-n-cpu.txt'", selector)
+        self.assertIn("href='?level=ERROR&render=runs&amp;"
+                      "compare=pass%2Fscreen-n-cpu.txt'", selector)
+
+    def test_compare_level(self):
+        gen = self.compare('compare=fail/screen-n-cpu.txt&level=ERROR')
+        self.assertEqual(list(gen), [])
+
+    def test_compare_renamed(self):
+        # the other log gets grouped into records like this one, even
+        # though from its name we wouldn't look for severities in it
+        with open(os.path.join(self.root, 'pass', 'renamed.txt'), 'w') as f:
+            f.write("".join(self.failing))
+        gen = self.compare('compare=pass/renamed.txt')
+        self.assertEqual(list(gen), [])
+
+    def test_compare_samples(self):
+        gen = log_wsgi.compare_filter(
+            base.samples_path() + 'screen-q-svc.txt.gz',
+            base.samples_path() + 'screen-q-svc.txt.gz', 'NONE', False)
+        self.assertEqual(list(gen), [])
+
+    def test_compare_bad_path(self):
+        self.assertEqual(self.compare('compare=../../etc/passwd'),
+                         ['Invalid compare url'])
+        self.assertEqual(self.compare('compare=nope.txt'),
+                         ['File Not Found'])
+
+
+class TestRender(base.TestCase):
+
+    def render(self, fname, render, level='NONE'):
+        return "".join(log_wsgi.html_filter(
+            base.samples_path() + fname, level, render))
+
+    def anchors(self, html):
+        return set(re.findall("<a name='([^']+)'", html))
+
+    def test_get_render(self):
+        self.assertEqual(log_wsgi.get_render({}), 'lines')
+        self.assertEqual(log_wsgi.get_render({'QUERY_STRING': 'render=js'}),
+                         'js')
+        self.assertEqual(log_wsgi.get_render({'QUERY_STRING': 'render=x'}),
+                         'lines')
+
+    def test_runs(self):
+        lines = self.render('screen-q-svc.txt.gz', 'lines')
+        runs = self.render('screen-q-svc.txt.gz', 'runs')
+        self.assertEqual(self.anchors(lines), self.anchors(runs))
+        self.assertTrue(len(runs) < len(lines) * 0.8)
+        self.assertTrue(runs.count('<span') < lines.count('<span') / 10)
+        self.assertIn("?level=ERROR&render=runs", runs)
+
+    def test_runs_spans(self):
+        self.assertEqual(
+            log_wsgi.html_renderer('lines', True, True)(
+                "2013-09-27 18:22:11.248 2820 INFO foo <bar>\n", 'INFO'),
+            "</span><span class='INFO _2013-09-27_18_22_11_248'>"
+            "<a name='_2013-09-27_18_22_11_248' class='date' "
+            "href='#_2013-09-27_18_22_11_248'>2013-09-27 18:22:11.248</a>"
+            " 2820 INFO foo &lt;bar&gt;\n")
+
+        htmlify = log_wsgi.html_renderer('runs', True, True)
+        self.assertEqual(
+            htmlify("2013-09-27 18:22:11.248 2820 INFO foo\n", 'INFO'),
+            "</span><span class='INFO'>"
+            "<a name='_2013-09-27_18_22_11_248' "
+            "href='#_2013-09-27_18_22_11_248'>2013-09-27 18:22:11.248</a>"
+            " 2820 INFO foo\n")
+        self.assertEqual(
+            htmlify("2013-09-27 18:22:11.248 2820 INFO bar\n", 'INFO'),
+            "2013-09-27 18:22:11.248 2820 INFO bar\n")
+        self.assertEqual(htmlify("  continued\n", 'INFO'), "  continued\n")
+        self.assertEqual(
+            htmlify("(keystone-all): 2013-09-27 18:22:11,249 ERROR x\n",
+                    'ERROR'),
+            "</span><span class='ERROR'>(keystone-all): "
+            "<a name='_2013-09-27_18_22_11_249' "
+            "href='#_2013-09-27_18_22_11_249'>2013-09-27 18:22:11,249</a>"
+            " ERROR x\n")
+
+    def test_js(self):
+        html = self.render('screen-key.txt.gz', 'js')
+        self.assertEqual(self.anchors(html), set())
+        self.assertIn(log_wsgi.ANCHOR_SCRIPT, html)
+        self.assertTrue(
+            len(html) < len(self.render('screen-key.txt.gz', 'lines')) / 2)
+
+    def test_no_sev(self):
+        lines = self.render('devstacklog.txt.gz', 'lines')
+        runs = self.render('devstacklog.txt.gz', 'runs')
+        self.assertEqual(self.anchors(lines), self.anchors(runs))
+        self.assertNotIn('<span class', runs)
+
+    def test_render_param(self):
+        gen = log_wsgi.application(
+            self.fake_env(PATH_INFO='/htmlify/screen-q-svc.txt.gz',
+                          QUERY_STRING='level=ERROR&render=runs',
+                          HTTP_ACCEPT='text/html'),
+            self._start_response, root_path=base.samples_path())
+        self.assertIn("?level=INFO&render=runs", gen.next())
+        self.assertIn("<span class='ERROR'>", gen.next())
+        # the second ERROR has a traceback, and carries on the ERROR span
+        record = gen.next()
+        self.assertNotIn("<span class='ERROR'>", record)
+        self.assertIn("delete failed\n</span><span class='TRACE'>", record)
+        gen.close()
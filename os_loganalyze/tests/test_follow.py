@@ -0,0 +1,269 @@
+#!/usr/bin/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Test following logs that are still being written
+"""
+
+import os
+import tempfile
+
+import fixtures
+
+from os_loganalyze import follow
+from os_loganalyze.tests import base
+import os_loganalyze.wsgi as log_wsgi
+
+
+LINES = [
+    "+ exec foo\n",
+    "2013-09-27 18:23:42.912 2820 DEBUG amqp [-] Channel open\n",
+    "2013-09-27 18:23:42.923 2820 ERROR neutron [-] delete failed\n",
+    "2013-09-27 18:23:42.923 2820 TRACE neutron Traceback\n",
+    "2013-09-27 18:23:42.924 2820 INFO neutron [-] done\n",
+    ]
+
+
+class TestFollow(base.TestCase):
+
+    def setUp(self):
+        super(TestFollow, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.FOLLOW_POLL_INTERVAL', 0.01))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.FOLLOW_IDLE_TIMEOUT', 1))
+        self.root = tempfile.mkdtemp() + '/'
+        self.fname = os.path.join(self.root, 'screen-n-cpu.txt')
+        self.append(LINES)
+
+    def append(self, lines):
+        with open(self.fname, 'a') as f:
+            f.write("".join(lines))
+
+    def follow(self, query='follow=1', html=False):
+        kwargs = {'PATH_INFO': '/htmlify/screen-n-cpu.txt',
+                  'QUERY_STRING': query}
+        if html:
+            kwargs['HTTP_ACCEPT'] = 'text/html'
+        return log_wsgi.application(
+            self.fake_env(**kwargs), self._start_response,
+            root_path=self.root)
+
+    def test_follow(self):
+        gen = self.follow()
+        self.assertEqual(gen.next(), "".join(LINES))
+
+        self.append(["2013-09-27 18:23:43.000 2820 INFO neutron [-] more\n",
+                     "\n"])
+        self.assertEqual(
+            gen.next(),
+            "2013-09-27 18:23:43.000 2820 INFO neutron [-] more\n\n")
+        gen.close()
+        self.assertEqual(follow.WATCHERS, {})
+
+    def test_follow_partial_line(self):
+        gen = self.follow()
+        gen.next()
+
+        self.append(["2013-09-27 18:23:43.000 2820 INFO neutron [-] mo"])
+        self.append(["re\n"])
+        self.assertEqual(
+            gen.next(),
+            "2013-09-27 18:23:43.000 2820 INFO neutron [-] more\n")
+        gen.close()
+
+    def test_follow_level(self):
+        gen = self.follow('follow=1&level=TRACE')
+        self.assertEqual(gen.next(), "".join(LINES[2:4]))
+
+        self.append(["2013-09-27 18:23:43.000 2820 INFO neutron [-] more\n",
+                     "2013-09-27 18:23:43.001 2820 TRACE neutron oops\n"])
+        self.assertEqual(gen.next(),
+                         "2013-09-27 18:23:43.001 2820 TRACE neutron oops\n")
+        gen.close()
+
+    def test_follow_tail(self):
+        gen = self.follow('follow=1&tail=2')
+        self.assertEqual(gen.next(), "".join(LINES[-2:]))
+        gen.close()
+
+    def test_follow_html(self):
+        gen = self.follow(html=True)
+        self.assertIn("Display level: ", gen.next())
+        self.assertIn("href='#_2013-09-27_18_23_42_912'", gen.next())
+
+        self.append(["2013-09-27 18:23:43.000 2820 INFO neutron [-] <b>\n"])
+        line = gen.next()
+        self.assertIn("class='INFO", line)
+        self.assertIn("&lt;b&gt;", line)
+        gen.close()
+
+    def test_follow_selector(self):
+        gen = self.follow('follow=1&tail=2&level=INFO', html=True)
+        self.assertIn("href='?level=ERROR&follow=1&amp;tail=2'", gen.next())
+        gen.close()
+
+    def test_idle_timeout(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.FOLLOW_IDLE_TIMEOUT', 0.05))
+        self.assertEqual(list(self.follow()), ["".join(LINES)])
+        self.assertEqual(follow.WATCHERS, {})
+
+    def test_shared_watcher(self):
+        first = self.follow()
+        second = self.follow()
+        first.next()
+        second.next()
+        self.assertEqual(follow.WATCHERS.keys(), [self.fname])
+        self.assertEqual(follow.WATCHERS[self.fname].followers, 2)
+
+        self.append(["foo\n"])
+        self.assertEqual(first.next(), "foo\n")
+        self.assertEqual(second.next(), "foo\n")
+        first.close()
+        self.assertEqual(follow.WATCHERS[self.fname].followers, 1)
+        second.close()
+        self.assertEqual(follow.WATCHERS, {})
+
+    def test_too_many_followers(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.MAX_FOLLOWERS', 1))
+        first = self.follow()
+        first.next()
+
+        # we just get what's there now
+        self.assertEqual(list(self.follow()), ["".join(LINES)])
+        first.close()
+
+    def test_too_many_followers_busy(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.MAX_FOLLOWERS', 0))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.CHEAP_RENDER_BYTES', -1))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.ADMISSION', self.make_admission(1, 0)))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.ADMISSION_TIMEOUT', 0))
+        statuses = []
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.tests.base.TestCase._start_response',
+            lambda self, status, headers: statuses.append(status)))
+
+        # settling for what's there now is a render like any other
+        token = log_wsgi.ADMISSION.acquire(1, 0)
+        self.assertEqual(self.follow(), ['Server Busy'])
+        self.assertEqual(statuses, ['503 Service Unavailable'])
+        log_wsgi.ADMISSION.release(token)
+        self.assertEqual(list(self.follow()), ["".join(LINES)])
+
+    def test_snapshot_admission(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.CHEAP_RENDER_BYTES', -1))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.ADMISSION', self.make_admission(1, 0)))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.ADMISSION_TIMEOUT', 0))
+        admission = log_wsgi.ADMISSION
+
+        # the snapshot holds a slot until it's been read, then following
+        # carries on without one
+        gen = self.follow()
+        self.assertEqual(admission.in_flight(),
+                         (1, len("".join(LINES))))
+        self.assertEqual(gen.next(), "".join(LINES))
+        self.append(["foo\n"])
+        self.assertEqual(gen.next(), "foo\n")
+        self.assertEqual(admission.in_flight(), (0, 0))
+        gen.close()
+
+        # and when there's no room we don't hang on to the watcher
+        token = admission.acquire(1, 0)
+        self.assertEqual(self.follow(), ['Server Busy'])
+        self.assertEqual(follow.WATCHERS, {})
+        admission.release(token)
+
+        gen = self.follow()
+        gen.close()
+        self.assertEqual(admission.in_flight(), (0, 0))
+        self.assertEqual(follow.WATCHERS, {})
+
+    def test_close_before_start(self):
+        gen = self.follow()
+        self.assertEqual(follow.WATCHERS[self.fname].followers, 1)
+        gen.close()
+        self.assertEqual(follow.WATCHERS, {})
+
+    def test_start_mid_line(self):
+        self.append(["2013-09-27 18:23:43.000 2820 INFO neutron [-] mo"])
+        gen = self.follow()
+        self.assertEqual(gen.next(), "".join(LINES))
+
+        self.append(["re\n"])
+        self.assertEqual(
+            gen.next(),
+            "2013-09-27 18:23:43.000 2820 INFO neutron [-] more\n")
+        gen.close()
+
+    def test_no_follow_gz(self):
+        gen = self.get_generator('screen-c-api.txt.gz', html=False)
+        gen.next()
+        self.assertEqual(follow.WATCHERS, {})
+
+
+class TestFollowHelpers(base.TestCase):
+
+    def test_split_lines(self):
+        self.assertEqual(follow.split_lines("a\r\nb\n\nc"),
+                         ["a\r\n", "b\n", "\n", "c"])
+        self.assertEqual(follow.split_lines("a\n"), ["a\n"])
+
+    def test_tail_offset(self):
+        fname = os.path.join(tempfile.mkdtemp(), 'log.txt')
+        with open(fname, 'w') as f:
+            f.write("a\nbb\nccc\n")
+        self.assertEqual(follow.tail_offset(fname, 9, 1), 5)
+        self.assertEqual(follow.tail_offset(fname, 9, 2), 2)
+        self.assertEqual(follow.tail_offset(fname, 9, 3), 0)
+        self.assertEqual(follow.tail_offset(fname, 9, 10), 0)
+        self.assertEqual(follow.tail_offset(fname, 5, 1), 2)
+
+    def test_line_end(self):
+        fname = os.path.join(tempfile.mkdtemp(), 'log.txt')
+        with open(fname, 'w') as f:
+            f.write("a\nbb")
+        self.assertEqual(follow.line_end(fname), 2)
+        with open(fname, 'a') as f:
+            f.write("\n")
+        self.assertEqual(follow.line_end(fname), 5)
+        with open(fname, 'w') as f:
+            f.write("a")
+        self.assertEqual(follow.line_end(fname), 0)
+
+    def test_get_link_params(self):
+        self.assertEqual(log_wsgi.get_link_params({}), [])
+        self.assertEqual(
+            log_wsgi.get_link_params(
+                {'QUERY_STRING': 'tail=5&level=INFO&follow=1&render=js'}),
+            [('follow', '1'), ('tail', '5')])
+
+    def test_get_follow(self):
+        self.assertEqual(log_wsgi.get_follow({}), (False, None))
+        self.assertEqual(log_wsgi.get_follow({'QUERY_STRING': 'follow=1'}),
+                         (True, None))
+        self.assertEqual(
+            log_wsgi.get_follow({'QUERY_STRING': 'follow=1&tail=100'}),
+            (True, 100))
+        self.assertEqual(
+            log_wsgi.get_follow({'QUERY_STRING': 'follow=1&tail=x'}),
+            (True, None))
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Test the load testing harness
+"""
+
+import gzip
+import json
+import os
+import random
+import StringIO
+import tempfile
+import threading
+from wsgiref import simple_server
+
+import fixtures
+
+from os_loganalyze.cmd import loadtest
+from os_loganalyze.tests import base
+import os_loganalyze.wsgi as log_wsgi
+
+
+TRACE = [
+    {'path': 'a/screen-n-api.txt.gz', 'size': 20000},
+    {'path': 'a/screen-n-api.txt.gz', 'level': 'ERROR', 'html': False},
+    {'path': 'b/screen-q-svc.txt', 'size': 10000, 'query': 'level=INFO'},
+    {'path': 'b/missing.txt'},
+    ]
+
+
+class QuietHandler(simple_server.WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class TestLoadTest(base.TestCase):
+
+    def setUp(self):
+        super(TestLoadTest, self).setUp()
+        self.root = tempfile.mkdtemp() + '/'
+
+    def test_make_tree(self):
+        loadtest.make_tree(self.root, TRACE[:3], random.Random(0))
+        data = gzip.open(self.root + 'a/screen-n-api.txt.gz').read()
+        self.assertTrue(20000 <= len(data) < 22000)
+        self.assertIn(' DEBUG ', data)
+        self.assertEqual(os.path.getsize(self.root + 'b/screen-q-svc.txt'),
+                         len(open(self.root + 'b/screen-q-svc.txt').read()))
+
+    def test_run(self):
+        loadtest.make_tree(self.root, TRACE[:3], random.Random(0))
+
+        def do_request(request):
+            return loadtest.inprocess_request(self.root, self.state_dir,
+                                              request)
+
+        results, elapsed = loadtest.run(TRACE * 3, 2, do_request)
+        summary = loadtest.summarize(2, results, elapsed)
+        self.assertEqual(summary['requests'], 12)
+        self.assertEqual(summary['errors'], 3)
+        self.assertAlmostEqual(summary['ok_rate'] / summary['error_rate'], 3)
+        self.assertTrue(summary['p50'] <= summary['p99'])
+        self.assertTrue(summary['ttfb_p50'] <= summary['p99'])
+
+    def test_http_request(self):
+        loadtest.make_tree(self.root, TRACE[:3], random.Random(0))
+
+        def app(environ, start_response):
+            environ[log_wsgi.STATE_DIR_ENV] = self.state_dir
+            return log_wsgi.application(
+                environ, start_response, root_path=self.root)
+
+        server = simple_server.make_server(
+            '127.0.0.1', 0, app, handler_class=QuietHandler)
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+
+        url = 'http://127.0.0.1:%d/' % server.server_port
+        status, ttfb, end, nbytes = loadtest.http_request(url, TRACE[0])
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(0 < ttfb <= end)
+        self.assertTrue(nbytes > 20000)
+        status, ttfb, end, nbytes = loadtest.http_request(url, TRACE[3])
+        self.assertEqual(status, '404 Not Found')
+
+    def test_main(self):
+        trace = os.path.join(self.root, 'trace.jsonl')
+        with open(trace, 'w') as f:
+            for request in TRACE[:3]:
+                f.write(json.dumps(request) + '\n')
+        before = os.listdir(self.state_dir)
+        loadtest.main([trace, '--concurrency', '1,2'])
+        # it had state of its own, and cleaned up after itself
+        self.assertFalse(os.path.exists(log_wsgi.STATE_DIR))
+        self.assertEqual(os.listdir(self.state_dir), before)
+
+    def test_url_needs_root(self):
+        self.useFixture(fixtures.MonkeyPatch('sys.stderr',
+                                             StringIO.StringIO()))
+        self.assertRaises(SystemExit, loadtest.main,
+                          ['--url', 'http://localhost/'])
+
+    def test_percentile(self):
+        self.assertEqual(loadtest.percentile([], 50), 0.0)
+        values = range(100)
+        self.assertEqual(loadtest.percentile(values, 50), 50)
+        self.assertEqual(loadtest.percentile(values, 99), 99)
+        self.assertEqual(loadtest.percentile([3, 1, 2], 100), 3)
@@ -18,8 +18,14 @@
 Test the ability to convert files into wsgi generators
 """
 
+import multiprocessing
+import sqlite3
+import threading
+import time
 import types
 
+import fixtures
+
 from os_loganalyze.tests import base
 import os_loganalyze.wsgi as log_wsgi
 
@@ -65,6 +71,150 @@ class TestWsgiBasic(base.TestCase):
         self.assertIn('<html>', first)
 
 
+class TestAdmission(base.TestCase):
+
+    def setUp(self):
+        super(TestAdmission, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.ADMISSION',
+            self.make_admission(1, 0)))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.ADMISSION_TIMEOUT', 0))
+        self.status = None
+        self.headers = None
+
+    def _start_response(self, status, headers):
+        self.status = status
+        self.headers = dict(headers)
+
+    def test_render_cost(self):
+        fname = base.samples_path() + 'screen-c-api.txt.gz'
+        self.assertEqual(log_wsgi.render_cost(fname, 'NONE', False), 0)
+        self.assertEqual(log_wsgi.render_cost(fname, 'INFO', False),
+                         78324 * log_wsgi.GZIP_RATIO)
+        self.assertEqual(log_wsgi.render_cost(fname, 'NONE', True),
+                         78324 * log_wsgi.GZIP_RATIO)
+
+    def test_busy(self):
+        first = self.get_generator('screen-key.txt.gz')
+        self.assertEqual(self.status, '200 OK')
+        self.assertIsInstance(first, log_wsgi.AdmittedRender)
+
+        gen = self.get_generator('screen-n-api.txt.gz')
+        self.assertEqual(self.status, '503 Service Unavailable')
+        self.assertEqual(self.headers['Retry-After'],
+                         str(log_wsgi.RETRY_AFTER))
+        self.assertEqual(gen, ['Server Busy'])
+
+        # cheap requests still get through
+        gen = self.get_generator('screen-c-api.txt.gz')
+        self.assertEqual(self.status, '200 OK')
+        gen = self.get_generator('screen-n-api.txt.gz', html=False)
+        self.assertEqual(self.status, '200 OK')
+        self.assertEqual(type(gen), types.GeneratorType)
+
+        first.close()
+        gen = self.get_generator('screen-n-api.txt.gz')
+        self.assertEqual(self.status, '200 OK')
+        gen.close()
+
+    def test_release_when_done(self):
+        gen = self.get_generator('screen-q-svc.txt.gz', level='ERROR',
+                                 html=False)
+        for line in gen:
+            pass
+        self.assertEqual(log_wsgi.ADMISSION.in_flight(), (0, 0))
+
+    def test_other_process(self):
+        def hold(release):
+            token = log_wsgi.ADMISSION.acquire(1, 0)
+            held.set()
+            done.wait()
+            if release:
+                log_wsgi.ADMISSION.release(token)
+
+        # another process using the last slot stops us rendering, until it
+        # releases the slot or dies without releasing it
+        for release in (True, False):
+            held = multiprocessing.Event()
+            done = multiprocessing.Event()
+            other = multiprocessing.Process(target=hold, args=(release,))
+            other.start()
+            held.wait()
+            self.assertEqual(log_wsgi.ADMISSION.in_flight(), (1, 1))
+            self.get_generator('screen-n-api.txt.gz')
+            self.assertEqual(self.status, '503 Service Unavailable')
+
+            done.set()
+            other.join()
+            gen = self.get_generator('screen-n-api.txt.gz')
+            self.assertEqual(self.status, '200 OK')
+            gen.close()
+            self.assertEqual(log_wsgi.ADMISSION.in_flight(), (0, 0))
+
+    def test_queued(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.ADMISSION', self.make_admission(1, 1)))
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.ADMISSION_TIMEOUT', 10))
+        admission = log_wsgi.ADMISSION
+        first = admission.acquire(1, 0)
+        got = []
+        waiter = threading.Thread(
+            target=lambda: got.append(admission.acquire(1, 10)))
+        waiter.start()
+        time.sleep(0.2)
+        # one waiting is all we queue
+        self.assertIsNone(admission.acquire(1, 10))
+        admission.release(first)
+        waiter.join()
+        self.assertIsNotNone(got[0])
+        self.assertEqual(admission.in_flight(), (1, 1))
+
+    def test_error_while_waiting(self):
+        admission = self.make_admission(1, 1)
+        first = admission.acquire(1, 0)
+
+        def broken(conn, cost, token=None):
+            raise sqlite3.OperationalError('database is locked')
+
+        # we let the render through, and don't leave our waiting row
+        # behind to hold up everyone after us
+        admission._fits = broken
+        self.assertEqual(admission.acquire(1, 5), log_wsgi.NO_TOKEN)
+        del admission._fits
+        admission.release(first)
+        self.assertEqual(admission.in_flight(), (0, 0))
+        self.assertNotIn(admission.acquire(10, 0.5),
+                         (None, log_wsgi.NO_TOKEN))
+
+    def test_failed_commit(self):
+        admission = self.make_admission(1, 1)
+        conn = admission._conn()
+
+        class FailingCommit(object):
+            def execute(self, sql, *args):
+                if sql == 'COMMIT':
+                    raise sqlite3.OperationalError('disk I/O error')
+                return conn.execute(sql, *args)
+
+        with fixtures.MonkeyPatch('os_loganalyze.wsgi.RenderAdmission._conn',
+                                  lambda self: FailingCommit()):
+            self.assertEqual(admission.acquire(1, 0), log_wsgi.NO_TOKEN)
+        # nothing was left half done on this thread's connection
+        self.assertNotIn(admission.acquire(1, 0), (None, log_wsgi.NO_TOKEN))
+        self.assertEqual(admission.in_flight(), (1, 1))
+
+    def test_expired(self):
+        admission = self.make_admission(1, 0)
+        self.useFixture(fixtures.MonkeyPatch(
+            'os_loganalyze.wsgi.MAX_RENDER_TIME', -1))
+        # a slot that was never released, by a process that's still alive
+        admission.acquire(1, 0)
+        self.assertNotIn(admission.acquire(1, 0), (None, log_wsgi.NO_TOKEN))
+        self.assertEqual(admission.in_flight(), (1, 1))
+
+
 class TestKnownFiles(base.TestCase):
     files = {
         'screen-c-api.txt.gz': {
@@ -101,9 +251,11 @@ class TestKnownFiles(base.TestCase):
             'DEBUG': 46912,
             'INFO': 262,
             'AUDIT': 0,
-            'TRACE': 589,
+            # every traceback in here is logged under an ERROR, so the
+            # TRACE lines are part of the ERROR records
+            'TRACE': 0,
             'WARNING': 48,
-            'ERROR': 72,
+            'ERROR': 661,
             }
         }
 
@@ -122,6 +274,9 @@ class TestKnownFiles(base.TestCase):
             counts['TOTAL'] = counts['TOTAL'] + 1
             for key in counts:
                 if ' %s ' % key in line:
+                    # tracebacks belong to the record they are logged under
+                    if key == 'TRACE' and laststatus == 'ERROR':
+                        continue
                     laststatus = key
                     continue
             if laststatus:
@@ -16,12 +16,23 @@
 
 
 import cgi
+import contextlib
+import errno
 import fileinput
+import itertools
 import os.path
 import re
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+import urllib
 import wsgiref.util
 
+from os_loganalyze import cache
+from os_loganalyze import follow
+
 # which logs support severity
 SUPPORTS_SEV = '(screen-(n-|c-|q-|g-|h-|ceil|key)|tempest\.txt)'
 
@@ -34,6 +45,124 @@ OSLO_LOGMATCH = '^(?P<date>%s)(?P<pid> \d+)? (?P<status>%s)' % \
 KEY_LOGMATCH = '^(?P<comp>%s) (?P<date>%s) (?P<status>%s)' % \
     (KEY_COMPONENT, DATEFMT, STATUSFMT)
 
+OSLO_RE = re.compile(OSLO_LOGMATCH)
+KEY_RE = re.compile(KEY_LOGMATCH)
+
+# ways we can render html, see html_renderer
+RENDERS = ('lines', 'runs', 'js')
+
+DATE_RE = re.compile('^(?P<comp>%s )?(?P<date>%s)' % (KEY_COMPONENT, DATEFMT))
+
+# links timestamps in the browser for render=js, the same way
+# RunRenderer does on our side, then jumps to the anchor in the url, as
+# it didn't exist when the page loaded
+ANCHOR_SCRIPT = r"""<script>
+(function () {
+  var date = /^(\([^\)]+\): )?(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d([.,]\d{3})?)/;
+  var pre = document.getElementsByTagName('pre')[0];
+  var walker = document.createTreeWalker(pre, NodeFilter.SHOW_TEXT, null,
+                                         false);
+  var found = [], last = null, linestart = true, node, m, nl, pos, name;
+  while ((node = walker.nextNode())) {
+    pos = 0;
+    while (pos < node.data.length) {
+      if (linestart && (m = date.exec(node.data.substr(pos, 64)))) {
+        name = '_' + m[2].replace(/[\s:.,]/g, '_');
+        if (name !== last) {
+          found.push([node, pos + (m[1] ? m[1].length : 0), m[2].length,
+                      name]);
+          last = name;
+        }
+      }
+      nl = node.data.indexOf('\n', pos);
+      linestart = nl >= 0;
+      if (nl < 0) {
+        break;
+      }
+      pos = nl + 1;
+    }
+  }
+  for (var i = found.length - 1; i >= 0; i--) {
+    var text = found[i][0].splitText(found[i][1]);
+    text.splitText(found[i][2]);
+    var a = document.createElement('a');
+    a.name = found[i][3];
+    a.href = '#' + found[i][3];
+    text.parentNode.replaceChild(a, text);
+    a.appendChild(text);
+  }
+  if (location.hash) {
+    var target = document.getElementsByName(location.hash.substr(1))[0];
+    if (target) {
+      target.scrollIntoView();
+    }
+  }
+})();
+</script>"""
+
+# tokens that change from run to run, which we throw away when comparing
+# logs from two runs, see normalize_line
+UUID = '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
+VOLATILE = [
+    (re.compile('^(%s)( \d+)?' % DATEFMT), ''),
+    (re.compile(DATEFMT), ''),
+    (re.compile('req-%s' % UUID), 'req-'),
+    (re.compile(UUID), 'UUID'),
+    (re.compile('\(\d+\)'), '(PID)'),
+    (re.compile('0x[0-9a-f]+'), '0x'),
+    ]
+
+# every line we can parse a severity out of starts with one of these, so
+# checking the first character lets us skip the regexes for continuation
+# lines, which are most of a traceback heavy log
+HEADER_START = frozenset('0123456789(')
+
+# a record is split after this many lines or bytes, so that a log with few
+# headers still streams, and we never hold too much of it in memory
+MAX_RECORD_LINES = 500
+MAX_RECORD_BYTES = 64 * 1024
+
+
+# admission control for expensive renders across the host, see
+# RenderAdmission. Costs are in bytes of uncompressed log we expect to
+# process for a request, and gzipped logs are guessed to be GZIP_RATIO
+# times their size on disk.
+GZIP_RATIO = 15
+CHEAP_RENDER_BYTES = 4 * 1024 * 1024
+MAX_RENDERS = 4
+MAX_RENDER_BYTES = 256 * 1024 * 1024
+MAX_QUEUED_RENDERS = 8
+ADMISSION_TIMEOUT = 5
+ADMISSION_POLL = 0.1
+RETRY_AFTER = 30
+# a slot held for longer than this is taken to have been leaked
+MAX_RENDER_TIME = 30 * 60
+
+# state shared between processes lives in this directory, which has to be
+# private to the user we run as, see configure. It can be set with
+# SetEnv OS_LOGANALYZE_STATE_DIR in apache.
+STATE_DIR = os.path.join(tempfile.gettempdir(),
+                         'os_loganalyze-%d' % os.getuid())
+STATE_DIR_ENV = 'OS_LOGANALYZE_STATE_DIR'
+
+# record indexes are shared between processes, see cache.IndexCache
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# ?follow=1 keeps streaming lines as they're appended to a log, see
+# follow_filter. Each follower holds a worker thread, so only a quarter of
+# the threads in a process may be following, leaving the rest for other
+# requests. Followers stop after FOLLOW_IDLE_TIMEOUT seconds with no new
+# lines.
+try:
+    import mod_wsgi
+    WORKER_THREADS = mod_wsgi.threads_per_process
+except (ImportError, AttributeError):
+    # mod_wsgi's default for a daemon process
+    WORKER_THREADS = 15
+FOLLOW_POLL_INTERVAL = 1
+FOLLOW_IDLE_TIMEOUT = 600
+MAX_FOLLOWERS = WORKER_THREADS // 4
+
 
 SEVS = {
     'NONE': 0,
@@ -46,12 +175,18 @@ SEVS = {
     }
 
 
-def _html_close():
+def _html_close(render="lines"):
+    if render == "js":
+        return "</span></pre>%s</body></html>\n" % ANCHOR_SCRIPT
     return ("</span></pre></body></html>\n")
 
 
-def _css_preamble(supports_sev):
-    """Write a valid html start with css that we need."""
+def _css_preamble(supports_sev, render="lines", params=()):
+    """Write a valid html start with css that we need.
+
+    params are (name, value) query parameters, from get_link_params, that
+    the level selector links keep along with the render.
+    """
     header = """<html>
 <head>
 <style>
@@ -67,17 +202,25 @@ a:hover {text-decoration: underline}
 </style>
 <body>"""
     if supports_sev:
-        header = header + """
+        selector = """
 <span class='selector'>
 Display level: [
-<a href='?'>ALL</a> |
-<a href='?level=DEBUG'>DEBUG</a> |
-<a href='?level=INFO'>INFO</a> |
-<a href='?level=AUDIT'>AUDIT</a> |
-<a href='?level=TRACE'>TRACE</a> |
-<a href='?level=WARNING'>WARNING</a> |
-<a href='?level=ERROR'>ERROR</a> ]
+<a href='?%(all)s'>ALL</a> |
+<a href='?level=DEBUG%(more)s'>DEBUG</a> |
+<a href='?level=INFO%(more)s'>INFO</a> |
+<a href='?level=AUDIT%(more)s'>AUDIT</a> |
+<a href='?level=TRACE%(more)s'>TRACE</a> |
+<a href='?level=WARNING%(more)s'>WARNING</a> |
+<a href='?level=ERROR%(more)s'>ERROR</a> ]
 </span>"""
+        # keep the same rendering, and whatever we're comparing or
+        # following, when switching level
+        params = list(params)
+        if render != "lines":
+            params.insert(0, ('render', render))
+        query = cgi.escape(urllib.urlencode(params), quote=True)
+        header += selector % {'all': query,
+                              'more': '&' + query if query else ''}
 
     header = header + "<pre><span>"
     return header
@@ -92,16 +235,157 @@ def not_html(fname):
     return re.search('(\.html(\.gz)?)$', fname) is None
 
 
-def sev_of_line(line, oldsev="NONE"):
-    m = re.match(OSLO_LOGMATCH, line)
-    if m:
-        return m.group('status')
+def header_sev(line):
+    """Return the severity of a record header line, or None.
+
+    None means this isn't a header, so the line is a continuation of
+    whatever record came before it.
+    """
+    if line[:1] not in HEADER_START:
+        return None
 
-    m = re.match(KEY_LOGMATCH, line)
+    m = OSLO_RE.match(line) or KEY_RE.match(line)
     if m:
         return m.group('status')
 
-    return oldsev
+    return None
+
+
+def sev_of_line(line, oldsev="NONE"):
+    return header_sev(line) or oldsev
+
+
+def log_records(lines, supports_sev=True):
+    """Group physical log lines into logical records.
+
+    A record is a header line we can parse a severity out of, plus all the
+    following lines we can't (multi-line messages, blank lines). TRACE
+    lines are also folded into the record before them, as oslo logs a
+    traceback as one TRACE line per line of the traceback under the
+    message that caused it.
+
+    This yields (sev, lines, line_sevs) tuples. sev is the most severe
+    level seen in the record, so that filtering by severity keeps a
+    traceback together with its message. line_sevs is the severity of each
+    line on its own, carrying the last one seen over unparsed lines, which
+    is what we color by. Lines before the first header are a record of
+    severity NONE. If the file doesn't support severity every line is its
+    own record.
+
+    Records longer than MAX_RECORD_LINES or MAX_RECORD_BYTES are split, and
+    the rest of the record carries on with the same severity.
+    """
+    if not supports_sev:
+        for line in lines:
+            yield "NONE", [line], ["NONE"]
+        return
+
+    sev = linesev = "NONE"
+    record = []
+    line_sevs = []
+    nbytes = 0
+    for line in lines:
+        newsev = header_sev(line)
+        if newsev is None or (newsev == "TRACE" and record):
+            if (len(record) >= MAX_RECORD_LINES or
+                    nbytes >= MAX_RECORD_BYTES):
+                yield sev, record, line_sevs
+                record = []
+                line_sevs = []
+                nbytes = 0
+            if newsev:
+                linesev = newsev
+                if SEVS.get(newsev, 0) > SEVS.get(sev, 0):
+                    sev = newsev
+            record.append(line)
+            line_sevs.append(linesev)
+            nbytes += len(line)
+            continue
+
+        if record:
+            yield sev, record, line_sevs
+        sev = linesev = newsev
+        record = [line]
+        line_sevs = [linesev]
+        nbytes = len(line)
+
+    if record:
+        yield sev, record, line_sevs
+
+
+def indexed_records(lines, index):
+    """Group lines into records using an index from _indexing_records.
+
+    This gives the same records as log_records without having to classify
+    any lines. The index only has the severity of the first line of each
+    record, so line_sevs is a generator that works out the rest if they're
+    needed, see line_sevs_of. If there turn out to be more lines than the
+    index covers, we fall back to log_records for the rest.
+    """
+    lines = iter(lines)
+    for first, num, sev, linesev in index:
+        record = list(itertools.islice(lines, num))
+        yield sev, record, line_sevs_of(record, linesev)
+
+    for record in log_records(lines):
+        yield record
+
+
+def line_sevs_of(record, linesev="NONE"):
+    """Generator of the severity of each line in a record.
+
+    linesev is the severity of the first line, which matters when a long
+    record was split and the rest of it carries on from the first part.
+    """
+    for line in record:
+        linesev = sev_of_line(line, linesev)
+        yield linesev
+
+
+def cached_records(fname, lines, supports_sev):
+    """Group lines into records, using the shared index if there is one.
+
+    If there isn't, we build the index as we go and store it once we've
+    been through the whole file, so it only gets built once per host.
+    """
+    if not supports_sev:
+        return log_records(lines, supports_sev)
+
+    index = INDEX_CACHE.get(fname)
+    if index is not None:
+        return indexed_records(lines, index)
+
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return log_records(lines, supports_sev)
+    return _indexing_records(fname, st, log_records(lines, supports_sev))
+
+
+def _indexing_records(fname, st, records):
+    """Pass records through, storing an index of them once we're done.
+
+    The index is a list of (first_line, num_lines, sev, first_line_sev)
+    tuples, one per record, with lines numbered from 0. st is the stat of
+    fname from before we started reading it. If the file changed while we
+    were reading it we don't know which lines the index is for, so we don't
+    store it.
+    """
+    index = []
+    lineno = 0
+    nbytes = 0
+    for sev, record, line_sevs in records:
+        index.append((lineno, len(record), sev, line_sevs[0]))
+        lineno += len(record)
+        nbytes += sum(len(line) for line in record)
+        yield sev, record, line_sevs
+
+    try:
+        now = os.stat(fname)
+    except OSError:
+        return
+    if (now.st_mtime, now.st_size) == (st.st_mtime, st.st_size):
+        INDEX_CACHE.put(fname, st, nbytes, index)
 
 
 def color_by_sev(line, sev):
@@ -152,17 +436,21 @@ def skip_line_by_sev(sev, minsev):
 
 
 def passthrough_filter(fname, minsev):
-    sev = "NONE"
     supports_sev = file_supports_sev(fname)
+    lines = fileinput.FileInput(fname, openhook=fileinput.hook_compressed)
 
-    for line in fileinput.FileInput(fname, openhook=fileinput.hook_compressed):
-        if supports_sev:
-            sev = sev_of_line(line, sev)
+    # nothing will be filtered, so don't bother working out records
+    if not supports_sev or SEVS.get(minsev, 0) == 0:
+        for line in lines:
+            yield line
+        return
 
-            if skip_line_by_sev(sev, minsev):
-                continue
+    for sev, record, _ in cached_records(fname, lines, supports_sev):
+        if skip_line_by_sev(sev, minsev):
+            continue
 
-        yield line
+        for line in record:
+            yield line
 
 
 def does_file_exist(fname):
@@ -183,34 +471,224 @@ def does_file_exist(fname):
     f.close()
 
 
-def html_filter(fname, minsev):
+def html_filter(fname, minsev, render="lines"):
     """Generator to read logs and output html in a stream.
 
     This produces a stream of the htmlified logs which lets us return
     data quickly to the user, and use minimal memory in the process.
+    Each chunk is one whole log record, so tracebacks are never split.
+    See html_renderer for the ways we can render the lines.
     """
 
     supports_sev = file_supports_sev(fname)
-    sev = "NONE"
-    should_escape = not_html(fname)
+    htmlify = html_renderer(render, not_html(fname), supports_sev)
 
-    yield _css_preamble(supports_sev)
+    yield _css_preamble(supports_sev, render)
 
-    for line in fileinput.FileInput(fname, openhook=fileinput.hook_compressed):
-        if should_escape:
-            newline = escape_html(line)
-        else:
-            newline = line
+    lines = fileinput.FileInput(fname, openhook=fileinput.hook_compressed)
+    for sev, record, line_sevs in cached_records(fname, lines, supports_sev):
+        if supports_sev and skip_line_by_sev(sev, minsev):
+            continue
 
-        if supports_sev:
-            sev = sev_of_line(newline, sev)
-            if skip_line_by_sev(sev, minsev):
-                continue
-            newline = color_by_sev(newline, sev)
+        yield "".join(htmlify(line, linesev)
+                      for line, linesev in zip(record, line_sevs))
+    yield _html_close(render)
 
-        newline = link_timestamp(newline)
-        yield newline
-    yield _html_close()
+
+def htmlify_line(line, sev, should_escape, supports_sev):
+    if should_escape:
+        line = escape_html(line)
+    if supports_sev:
+        line = color_by_sev(line, sev)
+    return link_timestamp(line)
+
+
+class RunRenderer(object):
+    """Render lines into html with one span per run of the same severity.
+
+    Wrapping every line in its own span, and linking every timestamp,
+    roughly doubles the size of a log. Here we only switch spans when the
+    severity changes, and only link the first line with each timestamp,
+    which is where a link to that timestamp goes anyway, so every anchor
+    the line at a time rendering has is still there.
+
+    Without anchors we don't link timestamps at all, and leave that to
+    ANCHOR_SCRIPT in the browser.
+    """
+
+    def __init__(self, should_escape, supports_sev, anchors=True):
+        self.should_escape = should_escape
+        self.supports_sev = supports_sev
+        self.anchors = anchors
+        self.sev = None
+        self.date = None
+
+    def __call__(self, line, sev):
+        if self.should_escape:
+            line = escape_html(line)
+        if self.anchors:
+            line = self.link_timestamp(line)
+        if self.supports_sev and sev != self.sev:
+            self.sev = sev
+            line = "</span><span class='%s'>%s" % (sev, line)
+        return line
+
+    def link_timestamp(self, line):
+        m = DATE_RE.match(line)
+        if not m:
+            return line
+
+        date = "_" + re.sub('[\s\:\.\,]', '_', m.group('date'))
+        if date == self.date:
+            return line
+        self.date = date
+        return "%s<a name='%s' href='#%s'>%s</a>%s" % (
+            line[:m.start('date')], date, date, m.group('date'),
+            line[m.end('date'):])
+
+
+def html_renderer(render, should_escape, supports_sev):
+    """Return a function to turn (line, sev) into html.
+
+    render is one of RENDERS. "lines" wraps each line in its own span and
+    links every timestamp. "runs" uses a span per run of lines with the
+    same severity, and fewer, smaller, links, see RunRenderer. "js" is like
+    "runs" but makes the links in the browser, which makes for the least
+    html to send.
+    """
+    if render == "runs":
+        return RunRenderer(should_escape, supports_sev)
+    if render == "js":
+        return RunRenderer(should_escape, supports_sev, anchors=False)
+
+    def htmlify(line, sev):
+        return htmlify_line(line, sev, should_escape, supports_sev)
+    return htmlify
+
+
+def normalize_line(line):
+    """Throw away the parts of a line that change from run to run."""
+    for regex, replacement in VOLATILE:
+        line = regex.sub(replacement, line)
+    return line
+
+
+def record_hash(record):
+    return hash("".join(normalize_line(line) for line in record))
+
+
+def compare_filter(fname, other, minsev, html, render="lines", params=()):
+    """Generator for the records in a log that aren't in another log.
+
+    This is for comparing a failing run's log with the same log from a
+    passing run. Records are compared after throwing away timestamps,
+    request ids, uuids and pids. We only hold a hash of each record of the
+    other log in memory, then stream the log itself, so this works on logs
+    that are far too big to diff in the usual way, and the output stays in
+    the order of the log.
+    """
+    supports_sev = file_supports_sev(fname)
+    htmlify = html_renderer(render, not_html(fname), supports_sev)
+
+    if html:
+        yield _css_preamble(supports_sev, render, params)
+
+    # the other log has to be split into records the same way as this one
+    # or its records won't match, whatever it's called
+    lines = fileinput.FileInput(other, openhook=fileinput.hook_compressed)
+    seen = set(record_hash(record) for _, record, _ in
+               cached_records(other, lines, supports_sev))
+
+    lines = fileinput.FileInput(fname, openhook=fileinput.hook_compressed)
+    for sev, record, line_sevs in cached_records(fname, lines, supports_sev):
+        if supports_sev and skip_line_by_sev(sev, minsev):
+            continue
+        if record_hash(record) in seen:
+            continue
+
+        if html:
+            record = [htmlify(line, linesev)
+                      for line, linesev in zip(record, line_sevs)]
+        yield "".join(record)
+
+    if html:
+        yield _html_close(render)
+
+
+def can_follow(fname):
+    """Only logs that are still being written can be followed.
+
+    Compressed logs are done, so there's nothing to follow.
+    """
+    return not fname.endswith('.gz')
+
+
+def follow_span(fname, watcher, tail=None):
+    """Find the part of a log to show before following it.
+
+    That's the whole log, or just its last tail lines, up to the end of the
+    last complete line, as that's where the watcher starts from. Returns
+    (start, end) offsets.
+    """
+    if watcher is None:
+        end = follow.line_end(fname)
+    else:
+        end = watcher.offset
+    start = 0
+    if tail:
+        start = follow.tail_offset(fname, end, tail)
+    return start, end
+
+
+def follow_filter(fname, snapshot, watcher, end, minsev, html,
+                  render="lines", params=()):
+    """Generator to stream a log and then whatever is appended to it.
+
+    This streams the snapshot, lists of lines of the log up to end from
+    follow.read_lines, then keeps the response open and streams new lines
+    from watcher as they are written, until no new lines turn up for
+    FOLLOW_IDLE_TIMEOUT seconds. All the followers of a file share one
+    watcher, see follow.FileWatcher. With no watcher we stop after the
+    snapshot.
+
+    We can't wait for the next header to find out where a record ends
+    here, so this works a line at a time. A record is kept or dropped on
+    its header line, and TRACE lines are shown whenever they are severe
+    enough, even if the message before them wasn't.
+    """
+    supports_sev = file_supports_sev(fname)
+    htmlify = html_renderer(render, not_html(fname), supports_sev)
+
+    if html:
+        yield _css_preamble(supports_sev, render, params)
+
+    chunks = snapshot
+    if watcher is not None:
+        chunks = itertools.chain(
+            chunks, watcher.follow(end, FOLLOW_IDLE_TIMEOUT))
+
+    linesev = "NONE"
+    show = not skip_line_by_sev(linesev, minsev)
+    for lines in chunks:
+        out = []
+        for line in lines:
+            if supports_sev:
+                newsev = header_sev(line)
+                if newsev:
+                    linesev = newsev
+                    if newsev != "TRACE" or not show:
+                        show = not skip_line_by_sev(newsev, minsev)
+                if not show:
+                    continue
+
+            if html:
+                line = htmlify(line, linesev)
+            out.append(line)
+        if out:
+            yield "".join(out)
+
+    if html:
+        yield _html_close(render)
 
 
 def htmlify_stdin():
@@ -235,10 +713,16 @@ def safe_path(root, environ):
     path = wsgiref.util.request_uri(environ, include_query=0)
     match = re.search('htmlify/(.*)', path)
     if match:
-        raw = match.groups(1)[0]
-        newpath = os.path.abspath(os.path.join(root, raw))
-        if newpath.find(root) == 0:
-            return newpath
+        return safe_join(root, match.groups(1)[0])
+
+    return None
+
+
+def safe_join(root, raw):
+    """Join a path onto root, or return None if it escapes root."""
+    newpath = os.path.abspath(os.path.join(root, raw))
+    if newpath.find(root) == 0:
+        return newpath
 
     return None
 
@@ -275,8 +759,342 @@ def get_min_sev(environ):
         return "NONE"
 
 
+def get_render(environ):
+    """Which of RENDERS to use for html, see html_renderer."""
+    parameters = cgi.parse_qs(environ.get('QUERY_STRING', ''))
+    render = parameters.get('render', ['lines'])[0]
+    if render not in RENDERS:
+        return 'lines'
+    return render
+
+
+def get_follow(environ):
+    """Do we follow the log, and how many lines back do we start?"""
+    parameters = cgi.parse_qs(environ.get('QUERY_STRING', ''))
+    if parameters.get('follow', [''])[0] not in ('1', 'true', 'yes'):
+        return False, None
+
+    try:
+        tail = int(parameters['tail'][0])
+    except (KeyError, ValueError):
+        tail = None
+    if tail is not None and tail <= 0:
+        tail = None
+    return True, tail
+
+
+def get_compare(root, environ):
+    """Find the log we're asked to compare against, if any.
+
+    This is given as ?compare=path, relative to the root like the path
+    in the url. Returns (asked, path), where path is None if it isn't safe.
+    """
+    parameters = cgi.parse_qs(environ.get('QUERY_STRING', ''))
+    if 'compare' not in parameters:
+        return False, None
+
+    return True, safe_join(root, parameters['compare'][0])
+
+
+def get_link_params(environ):
+    """The query parameters to keep in the level selector links.
+
+    Switching level should keep us on the same comparison, or following
+    the same way, so we pass on compare, follow and tail as they were.
+    """
+    parameters = cgi.parse_qs(environ.get('QUERY_STRING', ''))
+    return [(name, parameters[name][0])
+            for name in ('compare', 'follow', 'tail') if name in parameters]
+
+
+def render_cost(fname, minsev, html):
+    """Estimate how many bytes of log a request will make us process.
+
+    Plain text with no severity filter is just streaming the file back,
+    which is cheap no matter how big the file is, so that costs nothing.
+    If we've indexed the file before we know its real size.
+    """
+    if not html and SEVS.get(minsev, 0) == 0:
+        return 0
+
+    size = INDEX_CACHE.get_bytes(fname)
+    if size is not None:
+        return size
+
+    size = os.path.getsize(fname)
+    if fname.endswith('.gz'):
+        size = size * GZIP_RATIO
+    return size
+
+
+class RenderAdmission(object):
+    """Limit the expensive renders running at once on this host.
+
+    A burst of requests for huge logs would otherwise tie up every worker
+    for tens of seconds, starving the small requests. Renders are admitted
+    while there are fewer than max_renders running and their total cost
+    stays under max_bytes, and anything else waits for a slot, first come
+    first served. A render is always admitted when nothing else is
+    running, so a single log bigger than max_bytes can still be viewed.
+
+    Callers give up waiting after a timeout, and if max_queued are already
+    waiting we fail fast instead of queueing more.
+
+    mod_wsgi may run us in any number of processes, each with any number
+    of threads, so every render running or waiting is a row in a sqlite
+    file that all of them share. There's no way to wake up a waiter in
+    another process, so waiters check again every ADMISSION_POLL seconds.
+
+    Every row expires, waiters shortly after they would have given up and
+    renders after MAX_RENDER_TIME, and rows left behind by processes that
+    died are cleared out straight away. So a row we fail to delete can
+    only hold things up for so long.
+
+    This is only protection, so if we can't use the database we let
+    renders through rather than failing them, after doing our best to
+    take back our own row.
+    """
+
+    def __init__(self, path, max_renders, max_bytes, max_queued):
+        self.path = path
+        self.max_renders = max_renders
+        self.max_bytes = max_bytes
+        self.max_queued = max_queued
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = cache.local_connection(self._local, self.path)
+        if not getattr(self._local, 'ready', False):
+            # we do our own transactions, see _locked
+            conn.isolation_level = None
+            conn.execute('CREATE TABLE IF NOT EXISTS renders ('
+                         'id INTEGER PRIMARY KEY, pid INTEGER, '
+                         'cost INTEGER, running INTEGER, expires REAL)')
+            self._local.ready = True
+        return conn
+
+    @contextlib.contextmanager
+    def _locked(self, conn):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+            conn.execute('COMMIT')
+        except Exception:
+            try:
+                conn.execute('ROLLBACK')
+            except sqlite3.Error:
+                # we don't know what state it's in, start again with a
+                # new connection next time
+                self._local.__dict__.clear()
+            raise
+
+    def _forget(self, token):
+        """Delete our row, as best we can."""
+        for attempt in range(2):
+            try:
+                self._conn().execute('DELETE FROM renders WHERE id = ?',
+                                     (token,))
+                return
+            except sqlite3.Error:
+                self._local.__dict__.clear()
+
+    def _reap(self, conn):
+        conn.execute('DELETE FROM renders WHERE expires < ?', (time.time(),))
+        for (pid,) in conn.execute('SELECT DISTINCT pid FROM renders'):
+            try:
+                os.kill(pid, 0)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    conn.execute('DELETE FROM renders WHERE pid = ?', (pid,))
+
+    def _fits(self, conn, cost, token=None):
+        ahead = conn.execute(
+            'SELECT COUNT(*) FROM renders WHERE running = 0 AND id < ?',
+            (token or sys.maxint,)).fetchone()[0]
+        if ahead:
+            return False
+        renders, nbytes = self.in_flight(conn)
+        if renders == 0:
+            return True
+        return (renders < self.max_renders and
+                nbytes + cost <= self.max_bytes)
+
+    def in_flight(self, conn=None):
+        """Return how many renders are running, and their total cost."""
+        conn = conn or self._conn()
+        renders, nbytes = conn.execute(
+            'SELECT COUNT(*), TOTAL(cost) FROM renders '
+            'WHERE running = 1').fetchone()
+        return renders, int(nbytes)
+
+    def acquire(self, cost, timeout):
+        """Wait up to timeout seconds for a slot.
+
+        Returns a token to give back to release, or None if we didn't get
+        a slot.
+        """
+        deadline = time.time() + timeout
+        token = None
+        try:
+            conn = self._conn()
+            with self._locked(conn):
+                self._reap(conn)
+                fits = self._fits(conn, cost)
+                if fits:
+                    expires = time.time() + MAX_RENDER_TIME
+                else:
+                    waiting = conn.execute('SELECT COUNT(*) FROM renders '
+                                           'WHERE running = 0').fetchone()[0]
+                    if waiting >= self.max_queued:
+                        return None
+                    expires = deadline + ADMISSION_POLL * 10
+                token = conn.execute(
+                    'INSERT INTO renders (pid, cost, running, expires) '
+                    'VALUES (?, ?, ?, ?)',
+                    (os.getpid(), cost, int(fits), expires)).lastrowid
+            if fits:
+                return token
+
+            while True:
+                time.sleep(max(0, min(ADMISSION_POLL,
+                                      deadline - time.time())))
+                with self._locked(conn):
+                    if self._fits(conn, cost, token):
+                        conn.execute('UPDATE renders SET running = 1, '
+                                     'expires = ? WHERE id = ?',
+                                     (time.time() + MAX_RENDER_TIME, token))
+                        return token
+                    if time.time() >= deadline:
+                        conn.execute('DELETE FROM renders WHERE id = ?',
+                                     (token,))
+                        return None
+        except sqlite3.Error:
+            # anything we left behind would hold everyone else up
+            if token is not None:
+                self._forget(token)
+            return NO_TOKEN
+
+    def release(self, token):
+        if token != NO_TOKEN:
+            self._forget(token)
+
+
+class AdmittedRender(object):
+    """Hold an admission slot for as long as a generator is being served.
+
+    The wsgi server calls close() when it's done with the response, even if
+    the client went away, which is when we hand the slot back. We also hand
+    it back as soon as the generator runs out.
+    """
+
+    def __init__(self, generator, admission, token):
+        self.generator = generator
+        self.admission = admission
+        self.token = token
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self.generator.next()
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.generator.close()
+            self.release()
+
+    def release(self):
+        self.admission.release(self.token)
+
+
+class FollowingRender(AdmittedRender):
+    """Hold a follower on a watcher for as long as a generator is served.
+
+    The snapshot the generator streams first may hold an admission slot of
+    its own, which it gives back once it's been read, and we make sure it
+    does if the response is closed before then.
+    """
+
+    def __init__(self, generator, watcher, snapshot):
+        super(FollowingRender, self).__init__(generator, None, None)
+        self.watcher = watcher
+        self.snapshot = snapshot
+
+    def release(self):
+        self.snapshot.close()
+        follow.unwatch(self.watcher)
+
+
+# these get set up for real from the wsgi environment by configure
+ADMISSION = None
+INDEX_CACHE = cache.IndexCache(None, CACHE_MAX_BYTES)
+_state_dir = None
+
+
+def configure(environ):
+    """Set up the state we share with other processes.
+
+    It lives in OS_LOGANALYZE_STATE_DIR from the wsgi environment, or
+    STATE_DIR, which gets created only readable and writable by us. If it
+    already exists and anyone else could write to it, we can't trust
+    what's in it, so we do without. That means no index cache, and
+    admission limits for just this process, kept in a directory of its own.
+    """
+    global ADMISSION, INDEX_CACHE, _state_dir
+
+    state_dir = environ.get(STATE_DIR_ENV, STATE_DIR)
+    if state_dir == _state_dir:
+        return
+    _state_dir = state_dir
+
+    index_path = None
+    if cache.private_dir(state_dir):
+        index_path = os.path.join(state_dir, 'index.sqlite')
+        admission_dir = state_dir
+    else:
+        admission_dir = tempfile.mkdtemp()
+    INDEX_CACHE = cache.IndexCache(index_path, CACHE_MAX_BYTES)
+    ADMISSION = RenderAdmission(
+        os.path.join(admission_dir, 'admission.sqlite'),
+        MAX_RENDERS, MAX_RENDER_BYTES, MAX_QUEUED_RENDERS)
+
+
+def admit(generator, cost):
+    """Run a render through admission control.
+
+    Cheap renders always go straight through. Returns None if there's no
+    room for an expensive render.
+    """
+    if cost <= CHEAP_RENDER_BYTES:
+        return generator
+
+    token = ADMISSION.acquire(cost, ADMISSION_TIMEOUT)
+    if token is None:
+        return None
+    return AdmittedRender(generator, ADMISSION, token)
+
+
+# the token for a render we let through without admission control
+NO_TOKEN = 0
+
+
+def server_busy(start_response):
+    status = '503 Service Unavailable'
+    response_headers = [('Content-type', 'text/plain'),
+                        ('Retry-After', str(RETRY_AFTER))]
+    start_response(status, response_headers)
+    return ['Server Busy']
+
+
 def application(environ, start_response, root_path='/srv/static/logs/'):
     status = '200 OK'
+    configure(environ)
 
     logpath = safe_path(root_path, environ)
     if not logpath:
@@ -285,20 +1103,81 @@ def application(environ, start_response, root_path='/srv/static/logs/'):
         start_response(status, response_headers)
         return ['Invalid file url']
 
+    comparing, comparepath = get_compare(root_path, environ)
+    if comparing and not comparepath:
+        status = '400 Bad Request'
+        response_headers = [('Content-type', 'text/plain')]
+        start_response(status, response_headers)
+        return ['Invalid compare url']
+
     try:
         minsev = get_min_sev(environ)
-        if should_be_html(environ):
-            response_headers = [('Content-type', 'text/html')]
-            does_file_exist(logpath)
-            generator = html_filter(logpath, minsev)
+        html = should_be_html(environ)
+        render = get_render(environ)
+        params = get_link_params(environ)
+        does_file_exist(logpath)
+
+        following, tail = get_follow(environ)
+        following = following and can_follow(logpath)
+        watcher = None
+        if following:
+            # followers are limited by follow.watch, but the snapshot of
+            # the log we show first is a render like any other
+            watcher = follow.watch(logpath, FOLLOW_POLL_INTERVAL,
+                                   MAX_FOLLOWERS)
+            try:
+                start, end = follow_span(logpath, watcher, tail)
+            except IOError:
+                if watcher is not None:
+                    follow.unwatch(watcher)
+                raise
+            snapshot = follow.read_lines(logpath, start, end)
+            cost = end - start
+        if watcher is not None:
+            snapshot = admit(snapshot, cost)
+            if snapshot is None:
+                follow.unwatch(watcher)
+                return server_busy(start_response)
+
+            content_type = 'text/html' if html else 'text/plain'
+            response_headers = [('Content-type', content_type),
+                                ('Cache-Control', 'no-cache')]
             start_response(status, response_headers)
-            return generator
+            return FollowingRender(
+                follow_filter(logpath, snapshot, watcher, end, minsev, html,
+                              render, params),
+                watcher, snapshot)
+
+        if following:
+            # too many followers already, settle for what's there now
+            content_type = 'text/html' if html else 'text/plain'
+            response_headers = [('Content-type', content_type)]
+            generator = follow_filter(logpath, snapshot, None, end, minsev,
+                                      html, render, params)
+        elif comparing:
+            does_file_exist(comparepath)
+            content_type = 'text/html' if html else 'text/plain'
+            response_headers = [('Content-type', content_type)]
+            generator = compare_filter(logpath, comparepath, minsev, html,
+                                       render, params)
+            # we always have to classify both logs
+            cost = (render_cost(logpath, minsev, True) +
+                    render_cost(comparepath, minsev, True))
+        elif html:
+            response_headers = [('Content-type', 'text/html')]
+            generator = html_filter(logpath, minsev, render)
+            cost = render_cost(logpath, minsev, html)
         else:
             response_headers = [('Content-type', 'text/plain')]
-            does_file_exist(logpath)
             generator = passthrough_filter(logpath, minsev)
-            start_response(status, response_headers)
-            return generator
+            cost = render_cost(logpath, minsev, html)
+
+        generator = admit(generator, cost)
+        if generator is None:
+            return server_busy(start_response)
+
+        start_response(status, response_headers)
+        return generator
     except IOError:
         status = "404 Not Found"
         response_headers = [('Content-type', 'text/plain')]